@@ -12,21 +12,23 @@
 
 import os
 import io
+import hashlib
 import json
 import re
+import stat
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from difflib import SequenceMatcher
-from pathlib import Path
+from functools import lru_cache
+from typing import NamedTuple
 
+import numpy as np
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 st.set_page_config(page_title="교통법규 위반 고지서 OCR", page_icon="🚗", layout="wide")
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-import matplotlib.font_manager as fm
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 
 # Google Cloud Vision API
 try:
@@ -36,6 +38,13 @@ except ImportError:
     st.error("📦 Google Cloud Vision API가 필요합니다. 터미널에서 다음 명령을 실행하세요:\n\npip install google-cloud-vision")
     st.stop()
 
+# 차량번호 유사도 비교 (C++ 구현)
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    st.error("📦 추가 패키지가 필요합니다. 터미널에서 다음 명령을 실행하세요:\n\npip install rapidfuzz")
+    st.stop()
+
 # 클릭 캡처 컴포넌트
 try:
     from streamlit_image_coordinates import streamlit_image_coordinates
@@ -46,6 +55,18 @@ except ImportError:
 # =========================
 # 날짜 포맷 유틸 (항상 YYYY/MM/DD, 연도 없으면 당해년도)
 # =========================
+# 이미 정형화된 값(월 00~12, 일 00~31)은 변환 결과가 입력과 같으므로 그대로 반환
+_RE_CANONICAL = re.compile(r"\d{4}/(?:0\d|1[0-2])/(?:[0-2]\d|3[01])")
+_RE_NONDATE = re.compile(r"[^\d./\-년월일]")
+_RE_WS = re.compile(r"\s+")
+_RE_YYYYMMDD = re.compile(r'(?<!\d)(\d{4})(\d{2})(\d{2})(?!\d)')
+_RE_YYMMDD = re.compile(r'(?<!\d)(\d{2})(\d{2})(\d{2})(?!\d)')
+_RE_YMD_SEP = re.compile(r'(\d{2,4})\s*[-./]\s*(\d{1,2})\s*[-./]\s*(\d{1,2})')
+_RE_YEAR_KO = re.compile(r'(\d{2,4})\s*년')
+_RE_MONTH_KO = re.compile(r'(\d{1,2})\s*월')
+_RE_DAY_KO = re.compile(r'(\d{1,2})\s*일')
+_RE_MD_SEP = re.compile(r'(?<!\d)(\d{1,2})\s*[-./]\s*(\d{1,2})(?!\d)')
+_RE_DIGITS = re.compile(r'\d+')
 def fmt_date_uniform(s: str) -> str:
     """
     다양한 입력(yyyy.mm.dd, yyyy-m-d, mm.dd, mm-dd, yyyyMMdd, yyMMdd, yyyy년 m월 d일 등)을
@@ -57,87 +78,93 @@ def fmt_date_uniform(s: str) -> str:
         return f"{cur_year:04d}/00/00"
 
     src = str(s)
-    cleaned = re.sub(r"[^\d./\-년월일]", " ", src)
-    cleaned = re.sub(r"\s+", " ", cleaned).strip()
+    if _RE_CANONICAL.fullmatch(src):
+        return src
+    return _fmt_date_cache()(src, cur_year)
 
-    Y = None; M = None; D = None
+@st.cache_resource
+def _fmt_date_cache():
+    """스크립트는 rerun마다 다시 실행되어 모듈 수준 lru_cache도 새로 만들어짐.
+    메모이즈 함수를 cache_resource로 보관해 세션/재실행 간에 캐시를 유지.
+    본체를 이 안에서 정의해 본체 소스도 캐시 키에 포함 → 코드를 고치면 새 함수로 교체됨.
+    (st.cache_data는 인자 해싱+피클 비용이 파싱 자체보다 커서 사용하지 않음)
+    """
+    @lru_cache(maxsize=2048)
+    def _fmt_date_uniform_impl(src: str, cur_year: int) -> str:
+        """fmt_date_uniform 본체(순수 함수): 같은 OCR 문자열이 재실행마다 다시 들어오므로 결과를 메모이즈.
+        당해년도를 키에 포함해 연도가 바뀌면 새로 계산됨.
+        """
+        cleaned = _RE_WS.sub(" ", _RE_NONDATE.sub(" ", src)).strip()
 
-    # 0) 붙은 숫자: YYYYMMDD / YYMMDD
-    m = re.search(r'(?<!\d)(\d{4})(\d{2})(\d{2})(?!\d)', cleaned)
-    if m:
-        Y, M, D = m.group(1), m.group(2), m.group(3)
-    else:
-        m = re.search(r'(?<!\d)(\d{2})(\d{2})(\d{2})(?!\d)', cleaned)
+        Y = None; M = None; D = None
+
+        # 0) 붙은 숫자: YYYYMMDD / YYMMDD
+        m = _RE_YYYYMMDD.search(cleaned)
         if m:
-            Y, M, D = "20" + m.group(1), m.group(2), m.group(3)
-        else:
+            Y, M, D = m.groups()
+        elif (m := _RE_YYMMDD.search(cleaned)):
+            Y, M, D = m.groups()
+            Y = "20" + Y
+        elif (m := _RE_YMD_SEP.search(cleaned)):
             # 1) 구분자 있는 Y-M-D
-            m = re.search(r'(\d{2,4})\s*[-./]\s*(\d{1,2})\s*[-./]\s*(\d{1,2})', cleaned)
-            if m:
-                Y, M, D = m.group(1), m.group(2), m.group(3)
-            else:
-                # 2) 한글 표기
-                yk = re.search(r'(\d{2,4})\s*년', cleaned)
-                mk = re.search(r'(\d{1,2})\s*월', cleaned)
-                dk = re.search(r'(\d{1,2})\s*일', cleaned)
-                if yk or mk or dk:
-                    Y = yk.group(1) if yk else None
-                    M = mk.group(1) if mk else None
-                    D = dk.group(1) if dk else None
-                else:
-                    # 3) 연도 없는 M-D
-                    m2 = re.search(r'(?<!\d)(\d{1,2})\s*[-./]\s*(\d{1,2})(?!\d)', cleaned)
-                    if m2:
-                        M, D = m2.group(1), m2.group(2)
+            Y, M, D = m.groups()
+        elif any(ko := (_RE_YEAR_KO.search(cleaned), _RE_MONTH_KO.search(cleaned), _RE_DAY_KO.search(cleaned))):
+            # 2) 한글 표기
+            Y, M, D = (k.group(1) if k else None for k in ko)
+        elif (m := _RE_MD_SEP.search(cleaned)):
+            # 3) 연도 없는 M-D
+            M, D = m.groups()
+        else:
+            # 4) 숫자만 나열
+            nums = _RE_DIGITS.findall(cleaned)
+            if len(nums) >= 2:
+                a, b = nums[0], nums[1]
+                if len(a) == 4 and len(b) in (3, 4):
+                    Y = a
+                    if len(b) == 3:
+                        M, D = b[0], b[1:]
+                    else:
+                        M, D = b[:2], b[2:]
+                elif len(a) == 4 and len(b) <= 2:
+                    Y, M = a, b
+                elif len(a) <= 2 and len(b) in (3, 4):
+                    if len(b) == 3:
+                        M, D = b[0], b[1:]
                     else:
-                        # 4) 숫자만 나열
-                        nums = re.findall(r'\d+', cleaned)
-                        if len(nums) >= 2:
-                            a, b = nums[0], nums[1]
-                            if len(a) == 4 and len(b) in (3, 4):
-                                Y = a
-                                if len(b) == 3:
-                                    M, D = b[0], b[1:]
-                                else:
-                                    M, D = b[:2], b[2:]
-                            elif len(a) == 4 and len(b) <= 2:
-                                Y, M = a, b
-                            elif len(a) <= 2 and len(b) in (3, 4):
-                                if len(b) == 3:
-                                    M, D = b[0], b[1:]
-                                else:
-                                    M, D = b[:2], b[2:]
-                            elif len(a) <= 2 and len(b) <= 2:
-                                M, D = a, b
-                        elif len(nums) == 1:
-                            n = nums[0]
-                            if len(n) == 4:
-                                M, D = n[:2], n[2:]
-                            elif len(n) == 3:
-                                M, D = n[0], n[1:]
-                            else:
-                                M = n
-
-    # 보정/정형화
-    def norm_year(v):
-        if v is None: return f"{cur_year:04d}"
-        if len(v) == 2: v = "20" + v
-        return f"{int(v):04d}"
-
-    def norm_md(v):
-        if v is None: return "00"
-        return f"{int(v):02d}"
+                        M, D = b[:2], b[2:]
+                elif len(a) <= 2 and len(b) <= 2:
+                    M, D = a, b
+            elif len(nums) == 1:
+                n = nums[0]
+                if len(n) == 4:
+                    M, D = n[:2], n[2:]
+                elif len(n) == 3:
+                    M, D = n[0], n[1:]
+                else:
+                    M = n
 
-    try:
-        YY = norm_year(Y)
-        MM = norm_md(M)
-        DD = norm_md(D)
-        mi, di = int(MM), int(DD)
-        if mi < 1 or mi > 12: MM = "00"
-        if di < 1 or di > 31: DD = "00"
-        return f"{YY}/{MM}/{DD}"
-    except Exception:
-        return f"{cur_year:04d}/00/00"
+        # 보정/정형화
+        def norm_year(v):
+            if v is None: return f"{cur_year:04d}"
+            if len(v) == 2: v = "20" + v
+            return f"{int(v):04d}"
+
+        def norm_md(v):
+            if v is None: return "00"
+            return f"{int(v):02d}"
+
+        try:
+            YY = norm_year(Y)
+            MM = norm_md(M)
+            DD = norm_md(D)
+            mi, di = int(MM), int(DD)
+            if mi < 1 or mi > 12: MM = "00"
+            if di < 1 or di > 31: DD = "00"
+            return f"{YY}/{MM}/{DD}"
+        except Exception:
+            return f"{cur_year:04d}/00/00"
+
+    return _fmt_date_uniform_impl
 
 # =========================
 # Google Cloud Vision API 설정
@@ -207,6 +234,7 @@ def get_vision_client():
 # =========================
 @st.cache_resource
 def setup_korean_font():
+    """라벨용 PIL 폰트와 경로 반환 (없으면 None, PIL 기본 폰트 사용)"""
     malgun_paths = [
         "C:/Windows/Fonts/malgun.ttf",
         "C:/Windows/Fonts/malgunbd.ttf",
@@ -219,22 +247,16 @@ def setup_korean_font():
             chosen_font = font_path
             break
     pil_font = None
-    font_prop = None
     try:
         if chosen_font:
-            fm.fontManager.addfont(chosen_font)
-            font_prop = fm.FontProperties(fname=chosen_font)
-            mpl.rcParams["font.family"] = font_prop.get_name()
-            mpl.rcParams["axes.unicode_minus"] = False
             pil_font = ImageFont.truetype(chosen_font, size=18)
         else:
-            mpl.rcParams["axes.unicode_minus"] = False
             st.warning("⚠️ 맑은 고딕 폰트를 찾을 수 없습니다. 시스템 기본 폰트를 사용합니다.")
     except Exception as e:
         st.warning(f"맑은 고딕 폰트 로드 실패: {e}")
-    return font_prop, pil_font, chosen_font
+    return pil_font, chosen_font
 
-KFONT_PROP, PIL_FONT, KFONT_PATH = setup_korean_font()
+PIL_FONT, KFONT_PATH = setup_korean_font()
 
 # =========================
 # 상태 초기화
@@ -244,8 +266,9 @@ def init_session_state():
         "current_step": "upload_files",  # upload_files, template_setup, ocr_process, results
         "vehicle_users_df": None,
         "uploaded_image": None,          # 대표 이미지(템플릿 설정용)
-        "uploaded_images": [],           # 여러 장의 이미지
+        "uploaded_images": [],           # 여러 장의 이미지(작업용 축소본)
         "uploaded_image_names": [],      # 파일명 리스트
+        "uploaded_image_bytes": [],      # 업로드 원본 바이트(Vision 전송용, 재인코딩 없음)
         "template_exists": False,
         "coordinates": {},
         "current_field_index": 0,
@@ -256,6 +279,7 @@ def init_session_state():
         "ocr_results": {},
         "final_results": None,
         "batch_results": [],
+        "batch_csv": None,               # 결과 CSV 바이트(일괄 처리 끝에 한 번만 생성)
         "full_ocr_text": "",
         "is_police_notice": False,
     }
@@ -267,6 +291,7 @@ def init_session_state():
 # 상수 정의
 # =========================
 FIELDS = ["차량번호", "일자", "장소", "과태료", "납기일", "내용"]
+_FIELD_IDX = {f: i for i, f in enumerate(FIELDS)}
 FIELD_COLORS = {
     "차량번호": "#FF0000",
     "일자": "#0000FF",
@@ -283,6 +308,43 @@ FIELD_DESCRIPTIONS = {
     "납기일": "납기일은 'YYYY/MM/DD' 형식의 납부 기한입니다.",
     "내용": "내용은 '주정차', '속도', '신호', '어린이보호구역' 등이 포함됩니다.",
 }
+# 영역 이름 라벨 크기는 고정이므로 한 번만 측정
+_LABEL_BBOX = {f: PIL_FONT.getbbox(f) for f in FIELDS} if PIL_FONT else {}
+ROSTER_COLUMNS = ("차량번호", "성명", "부서", "사용자")  # 차량 사용자 파일에서 읽는 컬럼
+TEMPLATE_FILE = "police_template.json"
+VISION_BATCH_LIMIT = 16  # batch_annotate_images 요청당 최대 이미지 수
+WORK_MAX_SIDE = 1600     # 화면 작업용 축소본의 긴 변 최대 길이(px)
+VISION_MAX_SIDE = 2000   # Vision 전송 이미지의 긴 변 최대 길이(px)
+
+# =========================
+# 이미지 크기/좌표 유틸 (템플릿 좌표는 항상 원본 픽셀 기준)
+# =========================
+def get_full_size(img):
+    """작업용 축소본이면 원본 크기, 아니면 이미지 자체 크기"""
+    return img.info.get("full_size", img.size)
+
+def scale_box(coords, factor):
+    return [int(round(v * factor)) for v in coords]
+
+def coords_to_array(coordinates):
+    """{영역: [x1, y1, x2, y2]} → FIELDS 순서의 (N, 4) int32 배열 (미설정 영역은 -1)"""
+    arr = np.full((len(FIELDS), 4), -1, dtype=np.int32)
+    for field, coords in coordinates.items():
+        arr[_FIELD_IDX[field]] = coords
+    return arr
+
+def draft_jpeg(img, max_side):
+    """디코딩 전 JPEG이면 libjpeg가 1/2·1/4·1/8 배율로 바로 줄여 디코딩하도록 설정 (긴 변은 max_side 이상 유지)
+    크기가 바뀌므로 원본 크기는 호출 전에 따로 기억해야 함
+    """
+    longest = max(img.size)
+    if img.format == "JPEG" and longest > max_side:
+        w, h = img.size
+        img.draft("RGB", (-(-w * max_side // longest), -(-h * max_side // longest)))
+
+def decode_full_image(raw):
+    """OCR 크롭용 원본 이미지: 빈 영역을 재인식할 때만 업로드 바이트에서 디코딩"""
+    return Image.open(io.BytesIO(raw)).convert("RGB")
 
 # =========================
 # 파일 업로드 섹션
@@ -309,15 +371,20 @@ def file_upload_section():
         )
         if vehicle_file is not None:
             try:
-                df = pd.read_excel(vehicle_file)
+                # 필요한 컬럼만 문자열로 읽음 (없는 컬럼은 아래 필수 컬럼 검사에서 안내)
+                df = pd.read_excel(vehicle_file, usecols=lambda c: c in ROSTER_COLUMNS, dtype=str)
                 if "성명" not in df.columns and "사용자" in df.columns:
                     df["성명"] = df["사용자"]
+                if "차량번호" in df.columns:
+                    # 매칭 키(마지막 숫자 묶음의 뒤 4자리)는 로드할 때 한 번만 계산
+                    df["_last4"] = df["차량번호"].astype(str).str.extract(_RE_TAIL_DIGITS, expand=False).str[-4:]
                 st.session_state.vehicle_users_df = df
                 st.success(f"✅ 파일 로드 완료! (총 {len(df)}개 차량)")
-                st.dataframe(df.head(), use_container_width=True)
+                st.dataframe(df.head().drop(columns="_last4", errors="ignore"), use_container_width=True)
 
-                required = ["차량번호", "성명", "부서"]
-                missing = [c for c in required if c not in df.columns]
+                required = ("차량번호", "성명", "부서")
+                cols = set(df.columns)
+                missing = [c for c in required if c not in cols]  # 표시 순서 유지
                 if missing:
                     st.error(f"❌ 필수 컬럼이 없습니다: {missing}")
                 else:
@@ -340,18 +407,23 @@ def file_upload_section():
             if len(image_files) > 10:
                 st.error("❌ 최대 10장까지만 업로드할 수 있어요.")
             else:
+                # 이전 업로드를 먼저 놓아준 뒤 한 장씩 바로 세션에 적재
+                imgs = st.session_state.uploaded_images = []
+                names = st.session_state.uploaded_image_names = []
+                raws = st.session_state.uploaded_image_bytes = []
                 try:
-                    imgs, names = [], []
-                    for f in image_files:
-                        imgs.append(Image.open(f).convert("RGB"))
-                        names.append(getattr(f, "name", ""))
-                    st.session_state.uploaded_images = imgs
-                    st.session_state.uploaded_image_names = names
+                    for name, raw, img in iter_uploaded_images(image_files):
+                        imgs.append(img)
+                        names.append(name)
+                        raws.append(raw)
                     st.session_state.uploaded_image = imgs[0]
                     st.success(f"✅ 이미지 {len(imgs)}장 로드 완료!")
                     st.image(imgs[0], caption=f"대표(1번) 이미지: {names[0] if names else ''}", use_container_width=True)
-                    st.info(f"📊 대표 이미지 크기: {imgs[0].size[0]} × {imgs[0].size[1]} px")
+                    full_w, full_h = get_full_size(imgs[0])
+                    st.info(f"📊 대표 이미지 크기: {full_w} × {full_h} px")
                 except Exception as e:
+                    imgs.clear(); names.clear(); raws.clear()
+                    st.session_state.uploaded_image = None
                     st.error(f"❌ 이미지 읽기 오류: {e}")
 
     st.markdown("---")
@@ -371,7 +443,7 @@ def file_upload_section():
         c1, c2, c3 = st.columns([1, 2, 1])
         with c2:
             if st.button("🎯 다음 단계: 템플릿 설정", type="primary", use_container_width=True):
-                template_file = "police_template.json"
+                template_file = TEMPLATE_FILE
                 if os.path.exists(template_file):
                     st.session_state.template_exists = True
                     try:
@@ -399,19 +471,36 @@ def file_upload_section():
         reset_all_states()
         st.rerun()
 
+def iter_uploaded_images(files):
+    """업로드 파일을 한 장씩 디코딩해 (파일명, 원본 바이트, 작업용 축소본) 반환"""
+    for f in files:
+        raw = f.getvalue()
+        img = Image.open(io.BytesIO(raw))
+        full_size = img.size
+        draft_jpeg(img, WORK_MAX_SIDE)
+        img = img.convert("RGB")
+        # 화면 작업은 축소본으로, 원본은 바이트로만 보관(decode_full_image)
+        img.thumbnail((WORK_MAX_SIDE, WORK_MAX_SIDE), Image.Resampling.LANCZOS)
+        img.info["full_size"] = full_size
+        img.info["upload_key"] = hashlib.md5(raw).hexdigest()  # 렌더 캐시 키
+        name = getattr(f, "name", "")
+        yield name, raw, img
+
 def reset_all_states():
     keys = [
         "current_step", "vehicle_users_df", "uploaded_image", "uploaded_images", "uploaded_image_names",
+        "uploaded_image_bytes",
         "template_exists", "coordinates", "current_field_index", "temp_coords",
         "click_step", "display_width", "last_click_sig", "ocr_results", "final_results",
-        "batch_results", "full_ocr_text", "is_police_notice"
+        "batch_results", "batch_csv", "full_ocr_text", "is_police_notice"
     ]
     for k in keys:
         if k in st.session_state:
             if k == "current_step": st.session_state[k] = "upload_files"
             elif k == "display_width": st.session_state[k] = 800
             elif k in ["current_field_index", "click_step"]: st.session_state[k] = 0
-            elif k in ["uploaded_images", "uploaded_image_names", "temp_coords", "batch_results"]: st.session_state[k] = []
+            elif k in ["uploaded_images", "uploaded_image_names", "uploaded_image_bytes",
+                       "temp_coords", "batch_results"]: st.session_state[k] = []
             elif k in ["coordinates", "ocr_results"]: st.session_state[k] = {}
             else: st.session_state[k] = None
 
@@ -449,14 +538,14 @@ def create_template_sidebar():
 
     if st.session_state.uploaded_image:
         st.sidebar.markdown("### 🔍 이미지 크기 조절")
-        original_width = st.session_state.uploaded_image.size[0]
+        original_width, original_height = get_full_size(st.session_state.uploaded_image)
         st.session_state.display_width = st.sidebar.slider(
             "표시 너비(px)", min_value=400, max_value=min(1200, original_width),
             value=st.session_state.display_width, step=50
         )
         scale = st.session_state.display_width / original_width
         st.sidebar.caption(f"스케일 비율: {scale:.2f}")
-        st.sidebar.caption(f"원본 크기: {original_width} × {st.session_state.uploaded_image.size[1]}")
+        st.sidebar.caption(f"원본 크기: {original_width} × {original_height}")
 
     if st.session_state.coordinates:
         st.sidebar.markdown("### ✅ 완료된 영역")
@@ -508,53 +597,70 @@ def coordinate_selection_section():
 
     create_control_buttons(current_field)
 
-def create_image_with_overlays(current_field, field_color):
-    image = st.session_state.uploaded_image.copy()
+@st.cache_data(max_entries=8, show_spinner=False)
+def _render_saved_regions(_image, image_key, coords_arr, display_width):
+    """저장된 영역을 그린 뒤 표시 크기로 축소 (이미지/좌표/표시 너비가 바뀔 때만 다시 계산)"""
+    image = _image.copy()
     draw = ImageDraw.Draw(image)
+    factor = image.size[0] / get_full_size(image)[0]  # 원본 좌표 → 작업용 축소본 좌표
+    w = max(1, int(round(4 * factor)))
 
-    # 기존 저장된 영역
-    for field, coords in st.session_state.coordinates.items():
-        x1, y1, x2, y2 = coords
+    saved = np.flatnonzero(coords_arr[:, 0] >= 0)
+    boxes = np.rint(coords_arr[saved] * factor).astype(int).tolist()
+    for i, (x1, y1, x2, y2) in zip(saved, boxes):
+        field = FIELDS[i]
         color = FIELD_COLORS[field]
-        for i in range(4):
-            draw.rectangle([x1 - i, y1 - i, x2 + i, y2 + i], outline=color)
-        label = field
-        if PIL_FONT:
-            try:
-                bbox = draw.textbbox((0, 0), label, font=PIL_FONT)
-                tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
-                bx1, by1 = x1, max(0, y1 - th - 10)
-                bx2, by2 = x1 + tw + 10, max(0, y1 - 2)
-                draw.rectangle([bx1, by1, bx2, by2], fill=color)
-                draw.text((x1 + 5, by1 + 3), label, fill="white", font=PIL_FONT)
-            except:
-                draw.text((x1 + 5, y1 - 20), label, fill=color)
+        # 테두리는 바깥쪽으로 (width는 안쪽으로 그려지므로 w-1만큼 확장)
+        draw.rectangle([x1 - (w - 1), y1 - (w - 1), x2 + (w - 1), y2 + (w - 1)], outline=color, width=w)
+        if field in _LABEL_BBOX:
+            bbox = _LABEL_BBOX[field]
+            tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
+            bx1, by1 = x1, max(0, y1 - th - 10)
+            bx2, by2 = x1 + tw + 10, max(0, y1 - 2)
+            draw.rectangle([bx1, by1, bx2, by2], fill=color)
+            draw.text((x1 + 5, by1 + 3), field, fill="white", font=PIL_FONT)
+
+    scale = display_width / image.size[0]
+    return image.resize((display_width, int(image.size[1] * scale)), Image.Resampling.LANCZOS)
+
+def create_image_with_overlays(current_field, field_color):
+    """표시 크기 이미지 반환: 저장된 영역은 캐시에서, 임시 영역만 매번 축소 좌표로 그림"""
+    source = st.session_state.uploaded_image
+    display_width = st.session_state.display_width
+    coords_arr = coords_to_array(st.session_state.coordinates)
+    # cache_data는 호출마다 복사본을 돌려주므로 바로 그려도 캐시가 오염되지 않음
+    image = _render_saved_regions(source, source.info.get("upload_key", id(source)), coords_arr, display_width)
+    draw = ImageDraw.Draw(image)
+
+    scale = display_width / get_full_size(source)[0]
+    def pos(v): return int(round(v * scale))
+    def size(v): return max(1, int(round(v * scale)))
 
     # 현재 선택 중인 임시 영역
     if len(st.session_state.temp_coords) == 1:
-        x, y = st.session_state.temp_coords[0]
-        draw.line([x - 15, y, x + 15, y], fill=field_color, width=5)
-        draw.line([x, y - 15, x, y + 15], fill=field_color, width=5)
-        draw.ellipse([x - 10, y - 10, x + 10, y + 10], outline=field_color, width=3)
+        x, y = (pos(v) for v in st.session_state.temp_coords[0])
+        arm, r = size(15), size(10)
+        draw.line([x - arm, y, x + arm, y], fill=field_color, width=size(5))
+        draw.line([x, y - arm, x, y + arm], fill=field_color, width=size(5))
+        draw.ellipse([x - r, y - r, x + r, y + r], outline=field_color, width=size(3))
     elif len(st.session_state.temp_coords) == 2:
-        x1, y1 = st.session_state.temp_coords[0]
-        x2, y2 = st.session_state.temp_coords[1]
+        x1, y1 = (pos(v) for v in st.session_state.temp_coords[0])
+        x2, y2 = (pos(v) for v in st.session_state.temp_coords[1])
         x1, x2 = min(x1, x2), max(x1, x2)
         y1, y2 = min(y1, y2), max(y1, y2)
-        for i in range(6):
-            draw.rectangle([x1 - i, y1 - i, x2 + i, y2 + i], outline=field_color)
+        w, r = size(6), size(8)
+        draw.rectangle([x1 - (w - 1), y1 - (w - 1), x2 + (w - 1), y2 + (w - 1)], outline=field_color, width=w)
         for px, py in [(x1, y1), (x2, y2)]:
-            draw.ellipse([px - 8, py - 8, px + 8, py + 8], fill=field_color, outline="white", width=2)
+            draw.ellipse([px - r, py - r, px + r, py + r], fill=field_color, outline="white", width=size(2))
 
     return image
 
 def create_clickable_image_with_coordinates(current_field, field_color):
-    display_image = create_image_with_overlays(current_field, field_color)
-    original_width, original_height = st.session_state.uploaded_image.size
+    display_image_resized = create_image_with_overlays(current_field, field_color)
+    original_width, original_height = get_full_size(st.session_state.uploaded_image)
     display_width = st.session_state.display_width
     scale = display_width / original_width
-    display_height = int(original_height * scale)
-    display_image_resized = display_image.resize((display_width, display_height), Image.Resampling.LANCZOS)
+    display_height = display_image_resized.size[1]
 
     st.caption(f"🖱️ 이미지 크기: {display_width}×{display_height} (스케일: {scale:.2f}) — 영역을 클릭하세요")
 
@@ -669,32 +775,43 @@ def template_completion_section():
             st.session_state.current_step = "ocr_process"
             st.rerun()
 
+def _tag_size(draw, text):
+    l, t, r, b = draw.textbbox((0, 0), text, font=PIL_FONT)
+    return r - l + 8, b - t + 8
+
+def _draw_tag(draw, x, y, text, fill, outline=None, text_color="white"):
+    """(x, y)를 좌상단으로 하는 글자 상자"""
+    l, t, _, _ = draw.textbbox((0, 0), text, font=PIL_FONT)
+    w, h = _tag_size(draw, text)
+    draw.rectangle([x, y, x + w, y + h], fill=fill, outline=outline, width=2 if outline else 0)
+    draw.text((x + 4 - l, y + 4 - t), text, fill=text_color, font=PIL_FONT)
+
 def create_final_template_result():
     st.markdown("### 📸 최종 템플릿 결과")
     img = st.session_state.uploaded_image
-    fig, ax = plt.subplots(1, 1, figsize=(16, 12))
-    ax.imshow(img)
-    text_kwargs = {"fontproperties": KFONT_PROP} if KFONT_PROP else {}
-
-    for field, coords in st.session_state.coordinates.items():
-        x1, y1, x2, y2 = coords
+    factor = img.size[0] / get_full_size(img)[0]
+    boxes = [(field, coords, scale_box(coords, factor)) for field, coords in st.session_state.coordinates.items()]
+
+    # 반투명 채우기(alpha 0.25)는 RGBA 오버레이 합성으로
+    out = img.convert("RGBA")
+    overlay = Image.new("RGBA", out.size, (0, 0, 0, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    for field, _, box in boxes:
+        overlay_draw.rectangle(box, fill=ImageColor.getrgb(FIELD_COLORS[field]) + (64,))
+    out = Image.alpha_composite(out, overlay).convert("RGB")
+
+    draw = ImageDraw.Draw(out)
+    for field, (ox1, oy1, ox2, oy2), (x1, y1, x2, y2) in boxes:
         color = FIELD_COLORS[field]
-        rect = patches.Rectangle((x1, y1), x2 - x1, y2 - y1,
-                                 linewidth=4, edgecolor=color, facecolor=color, alpha=0.25)
-        ax.add_patch(rect)
-        ax.text(x1, y1 - 25, field, color="black", fontsize=16, fontweight="bold",
-                bbox=dict(boxstyle="round,pad=0.8", facecolor="white", alpha=0.95,
-                          edgecolor=color, linewidth=3), **text_kwargs)
-        ax.text(x1 + 5, y1 + 5, f"({x1},{y1})", color="white", fontsize=10, fontweight="bold",
-                bbox=dict(boxstyle="round,pad=0.4", facecolor=color, alpha=0.8), **text_kwargs)
-        ax.text(x2 - 5, y2 - 5, f"({x2},{y2})", color="white", fontsize=10, fontweight="bold",
-                bbox=dict(boxstyle="round,pad=0.4", facecolor=color, alpha=0.8),
-                ha="right", va="bottom", **text_kwargs)
-    ax.set_title("🎯 교통법규 위반 고지서 OCR 템플릿", fontsize=18, pad=30, fontweight="bold", **text_kwargs)
-    ax.axis("off")
-    plt.tight_layout()
-    st.pyplot(fig)
-    plt.close(fig)
+        draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
+        _, lh = _tag_size(draw, field)
+        _draw_tag(draw, x1, max(0, y1 - lh - 4), field, fill="white", outline=color, text_color="black")
+        _draw_tag(draw, x1 + 4, y1 + 4, f"({ox1},{oy1})", fill=color)
+        br = f"({ox2},{oy2})"
+        bw, bh = _tag_size(draw, br)
+        _draw_tag(draw, x2 - 4 - bw, y2 - 4 - bh, br, fill=color)
+
+    st.image(out, caption="🎯 교통법규 위반 고지서 OCR 템플릿", use_container_width=True)
 
 def create_coordinates_table():
     st.markdown("### 📋 설정된 좌표 정보")
@@ -710,16 +827,32 @@ def save_template():
     template_data = {
         "template_name": "경찰서_고지서_템플릿",
         "created_at": datetime.now().isoformat(),
-        "image_size": list(st.session_state.uploaded_image.size),
-        "coordinates": st.session_state.coordinates,
+        "image_size": list(get_full_size(st.session_state.uploaded_image)),
+        "coordinates": {k: list(v) for k, v in st.session_state.coordinates.items()},
     }
     try:
-        with open("police_template.json", 'w', encoding='utf-8') as f:
-            json.dump(template_data, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(TEMPLATE_FILE, template_data)
         st.success("✅ 템플릿이 저장되었습니다!")
     except Exception as e:
         st.error(f"❌ 템플릿 저장 실패: {e}")
 
+def _write_json_atomic(path, data):
+    """같은 폴더의 고유 임시 파일(<파일명>.XXXX.tmp)에 쓴 뒤 os.replace로 교체
+    → 중간에 죽어도 반쯤 쓰인 파일이 남지 않고, 동시에 저장해도 임시 파일이 섞이지 않음
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)  # 읽는 쪽은 json.load뿐이라 들여쓰기 없이
+        # mkstemp은 0600으로 만들므로 기존 파일 권한을 이어받음 (처음 만들 때는 0644)
+        mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
 def reset_template():
     st.session_state.coordinates = {}
     st.session_state.current_field_index = 0
@@ -749,6 +882,7 @@ def ocr_process_section():
 def process_all_images():
     images = st.session_state.uploaded_images or []
     names = st.session_state.uploaded_image_names or []
+    raws = st.session_state.uploaded_image_bytes or []
     if not images:
         st.error("이미지가 없습니다.")
         return
@@ -766,47 +900,49 @@ def process_all_images():
         all_results = []
         total = len(images)
 
-        for idx, img in enumerate(images, start=1):
-            st.session_state.uploaded_image = img
-            progress_bar.progress(int((idx - 1) / total * 100))
-            status_text.text(f"📄 ({idx}/{total}) 전체 이미지 텍스트 분석 중...")
+        status_text.text(f"📄 전체 이미지 {total}장 텍스트 일괄 분석 중...")
+        pages = perform_full_image_ocr_batch(vision_client, raws)
 
-            full_text = perform_full_image_ocr(vision_client)
-            st.session_state.full_ocr_text = full_text
-
-            # 분류: "경찰청 고지" 유무 (공백 제거 버전 포함)
-            status_text.text(f"🕵️ ({idx}/{total}) 이미지 유형 분석 중...")
-            is_police = classify_image_type(full_text)
-            st.session_state.is_police_notice = is_police
-
-            # 본 처리
-            if is_police:
-                status_text.text(f"🎯 ({idx}/{total}) 템플릿 기반 OCR 처리 중...")
-                if st.session_state.coordinates:
-                    ocr_results = process_template_based_ocr(vision_client)
-                else:
-                    st.error("❌ 저장된 템플릿이 없습니다. 템플릿을 먼저 설정해주세요.")
-                    return
-            else:
-                status_text.text(f"🔍 ({idx}/{total}) 키워드 기반 정보 추출 중...")
-                ocr_results = process_keyword_based_ocr(full_text)
-
-            st.session_state.ocr_results = ocr_results
-
-            # 차량번호 매칭
-            status_text.text(f"🚗 ({idx}/{total}) 차량번호 매칭 중...")
-            matched_vehicle = match_vehicle_number(ocr_results.get("차량번호", ""))
+        # 분류: "경찰청 고지" 유무 (공백 제거 버전 포함)
+        status_text.text("🕵️ 이미지 유형 분석 중...")
+        police_flags = [classify_image_type(full_text) for full_text, _ in pages]
+        if any(police_flags) and not st.session_state.coordinates:
+            st.error("❌ 저장된 템플릿이 없습니다. 템플릿을 먼저 설정해주세요.")
+            return
 
-            # 결과 정리
-            status_text.text(f"📊 ({idx}/{total}) 결과 정리 중...")
-            final_result = compile_final_results(matched_vehicle)
-            if names and len(names) >= idx:
-                final_result["파일명"] = names[idx - 1]
-            final_result["_index"] = idx
-            final_result["분류"] = "경찰서(경찰청 고지)" if is_police else "일반 고지서"
-            all_results.append(final_result)
+        # 이미지별 처리는 Vision 재인식(I/O) 대기가 대부분이라 스레드로 동시 실행
+        status_text.text(f"🔍 이미지 {total}장 정보 추출 중...")
+        workers = int(os.getenv("OCR_CONCURRENCY", 8))
+        # 작업 스레드는 세션 상태를 읽지 않도록 필요한 입력을 미리 떠서 인자로 넘김
+        coordinates = {k: list(v) for k, v in st.session_state.coordinates.items()}
+        roster = st.session_state.vehicle_users_df
+        last4_index = build_last4_index(roster)
+        ctx = get_script_run_ctx()  # 작업 스레드의 st.warning이 화면에 표시되도록 연결
+        outputs = {}
+        report_every = max(1, total // 50)  # 진행 표시는 화면으로 메시지가 가므로 많을 때는 솎아서 갱신
+        with ThreadPoolExecutor(max_workers=workers, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+            futures = {
+                ex.submit(_process_one, vision_client, idx, names[idx - 1] if len(names) >= idx else None,
+                          pages[idx - 1], police_flags[idx - 1], raws[idx - 1],
+                          coordinates, roster, last4_index): idx
+                for idx in range(1, total + 1)
+            }
+            for done, fut in enumerate(as_completed(futures), start=1):
+                final_result, ocr_results = fut.result()
+                outputs[futures[fut]] = ocr_results
+                all_results.append(final_result)
+                if done % report_every == 0 or done == total:
+                    progress_bar.progress(int(done / total * 100))
+                    status_text.text(f"📊 ({done}/{total}) 처리 완료")
+
+        all_results.sort(key=lambda r: r["_index"])
+        # 화면 표시용 단일 결과는 기존처럼 마지막 이미지 기준
+        st.session_state.full_ocr_text = pages[-1][0]
+        st.session_state.is_police_notice = police_flags[-1]
+        st.session_state.ocr_results = outputs[total]
 
         st.session_state.batch_results = all_results
+        st.session_state.batch_csv = batch_results_frame(all_results).to_csv(index=False).encode("utf-8-sig")
         progress_bar.progress(100)
         status_text.text("✅ OCR 일괄 처리 완료!")
         st.success("🎉 모든 이미지 처리 완료!")
@@ -815,117 +951,240 @@ def process_all_images():
     except Exception as e:
         st.error(f"❌ OCR 일괄 처리 중 오류 발생: {e}")
 
-def perform_full_image_ocr(vision_client):
-    try:
-        img_byte_arr = io.BytesIO()
-        st.session_state.uploaded_image.save(img_byte_arr, format='PNG')
-        image = vision.Image(content=img_byte_arr.getvalue())
-        response = vision_client.text_detection(image=image)
-        if response.error.message:
-            raise Exception(f'{response.error.message}')
-        texts = response.text_annotations
-        return texts[0].description.strip() if texts else ""
-    except Exception as e:
-        st.warning(f"⚠️ 전체 이미지 OCR 실패: {e}")
-        return ""
+def _process_one(vision_client, idx, name, page, is_police, raw, coordinates, roster, last4_index):
+    """이미지 한 장 처리 (작업 스레드에서 실행되므로 세션 상태를 읽거나 쓰지 않고 인자만 사용해 결과를 반환)"""
+    full_text, words = page
+    if is_police:
+        ocr_results = process_template_based_ocr(vision_client, words, coordinates, raw)
+    else:
+        ocr_results = process_keyword_based_ocr(full_text)
+
+    # 차량번호 매칭 → 결과 정리
+    matched_vehicle = match_vehicle_number(ocr_results.get("차량번호", ""), roster, last4_index)
+    final_result = compile_final_results(matched_vehicle, ocr_results)
+    if name is not None:
+        final_result["파일명"] = name
+    final_result["_index"] = idx
+    final_result["분류"] = "경찰서(경찰청 고지)" if is_police else "일반 고지서"
+    return final_result, ocr_results
+
+def _encode_jpeg(img, quality=85):
+    """PIL 이미지를 JPEG 바이트로 인코딩 (optimize는 허프만 최적화를 한 번 더 돌리므로 생략)"""
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, optimize=False)
+    return buf.getvalue()
+
+def _prep_for_vision(img, max_side=VISION_MAX_SIDE, quality=85):
+    """Vision 전송용 JPEG 바이트와 좌표 환산 배율(원본/전송본) 반환: 긴 변이 max_side를 넘으면 축소"""
+    factor = 1.0
+    if max(img.size) > max_side:
+        width = img.size[0]
+        img = img.copy()
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        factor = width / img.size[0]
+    return _encode_jpeg(img, quality), factor
+
+def _page_payload(raw):
+    """전체 이미지 OCR용 전송 데이터: 작은 JPEG 업로드는 그대로, 큰 사진·PNG 등은 축소 JPEG로"""
+    img = Image.open(io.BytesIO(raw))
+    if img.format == "JPEG" and max(img.size) <= VISION_MAX_SIDE:
+        return raw, 1.0
+    width = img.size[0]
+    draft_jpeg(img, VISION_MAX_SIDE)
+    img = img.convert("RGB")
+    content, factor = _prep_for_vision(img)
+    return content, factor * width / img.size[0]  # 축소 디코딩 배율까지 포함해 원본 픽셀 기준으로
+
+def _annotate_pages(vision_client, payload_futures):
+    """전송용 인코딩이 끝난 묶음을 한 번에 요청, 응답과 이미지별 좌표 배율 반환"""
+    payloads = [f.result() for f in payload_futures]
+    responses = _annotate_chunk(vision_client, [content for content, _ in payloads])
+    return responses, [factor for _, factor in payloads]
+
+def _annotate_chunk(vision_client, contents):
+    """이미지 바이트 묶음(최대 VISION_BATCH_LIMIT장)을 한 번의 batch_annotate_images 요청으로 전송"""
+    requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(content=content),
+            features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+        )
+        for content in contents
+    ]
+    return vision_client.batch_annotate_images(requests=requests).responses
+
+def _word_boxes(annotations, factor=1.0):
+    """text_annotations[1:](단어 단위) → [(단어, 중심 x, 중심 y)], 좌표는 factor를 곱해 원본 픽셀 기준으로"""
+    words = []
+    for ann in annotations[1:]:
+        vertices = ann.bounding_poly.vertices
+        if not vertices:
+            continue
+        cx = sum(v.x for v in vertices) / len(vertices) * factor
+        cy = sum(v.y for v in vertices) / len(vertices) * factor
+        words.append((ann.description, cx, cy))
+    return words
+
+def perform_full_image_ocr_batch(vision_client, contents):
+    """전체 이미지 OCR 일괄 처리: 업로드 원본 바이트를 16장 단위로 묶어 요청, 묶음이 여러 개면 동시에 전송
+    큰 이미지는 긴 변 VISION_MAX_SIDE의 JPEG로 줄여 보내고, 단어 좌표는 원본 픽셀 기준으로 되돌림
+    반환: 이미지별 (전체 텍스트, 단어 좌표 목록)
+    """
+    chunks = [contents[i:i + VISION_BATCH_LIMIT] for i in range(0, len(contents), VISION_BATCH_LIMIT)]
+    # 인코딩(libjpeg, GIL 해제)은 전부 한꺼번에 시작하고, 묶음마다 제 인코딩이 끝나는 대로 바로 전송
+    # → 앞 묶음의 응답을 기다리는 동안 뒤 묶음 인코딩이 겹쳐서 진행됨
+    with ThreadPoolExecutor() as enc, ThreadPoolExecutor(max_workers=max(1, len(chunks))) as ex:
+        futures = [
+            ex.submit(_annotate_pages, vision_client, [enc.submit(_page_payload, raw) for raw in chunk])
+            for chunk in chunks
+        ]
+
+    pages = []
+    for chunk, fut in zip(chunks, futures):
+        try:
+            responses, factors = fut.result()
+        except Exception as e:
+            st.warning(f"⚠️ 전체 이미지 OCR 실패: {e}")
+            pages.extend([("", [])] * len(chunk))
+            continue
+        for response, factor in zip(responses, factors):
+            if response.error.message:
+                st.warning(f"⚠️ 전체 이미지 OCR 실패: {response.error.message}")
+                pages.append(("", []))
+                continue
+            texts = response.text_annotations
+            pages.append((texts[0].description.strip() if texts else "", _word_boxes(texts, factor)))
+    return pages
+
+# "경찰청고지"를 글자 사이 공백 무시하고 한 번에 탐색 (공백 제거 사본을 만들지 않음)
+_RE_POLICE_NOTICE = re.compile(r"경\s*찰\s*청\s*고\s*지")
 
 def classify_image_type(full_text):
     if not full_text:
         return False
-    joined = re.sub(r"\s+", "", full_text)
-    return ("경찰청 고지" in full_text) or ("경찰청고지" in joined)
+    return _RE_POLICE_NOTICE.search(full_text) is not None
 
-def process_template_based_ocr(vision_client):
+def process_template_based_ocr(vision_client, words, coordinates, raw):
+    """전체 이미지 OCR의 단어 좌표를 템플릿 영역별로 모아 사용, 비어 있는 영역만 원본에서 한 번에 재인식"""
     ocr_results = {}
-    for field, coords in st.session_state.coordinates.items():
+    missing = {}
+    for field, coords in coordinates.items():
         try:
-            extracted_text = extract_text_from_region(vision_client, None, field, coords)
-            ocr_results[field] = extracted_text
+            ocr_results[field] = extract_text_from_words(words, field, coords)
         except Exception as e:
             st.warning(f"⚠️ {field} 영역 처리 실패: {e}")
             ocr_results[field] = ""
+        if not ocr_results[field]:
+            missing[field] = coords
+    if missing:
+        ocr_results.update(extract_text_from_regions(vision_client, decode_full_image(raw), missing))
     return ocr_results
 
 def process_keyword_based_ocr(full_text):
-    ocr_results = {
-        "차량번호": extract_vehicle_number_from_text(full_text),
-        "일자": extract_date_from_text(full_text, ["일시", "일자", "위반일", "발생일"]),
-        "장소": extract_location_from_text(full_text),
-        "과태료": extract_fine_amount_from_text(full_text),
-        "납기일": extract_date_from_text(full_text, ["납부기한", "납기", "기한", "만료일"]),
-        "내용": extract_violation_content_from_text(full_text),
-    }
-    return ocr_results
+    return extract_all_fields(full_text)
 
 # =========================
 # 필드별 텍스트 추출/후처리
 # =========================
-def extract_vehicle_number_from_text(text):
-    """차량번호: 1) ROI 우선 2) 뒤 4자리만 사용"""
-    try:
-        if "coordinates" in st.session_state and "차량번호" in st.session_state.coordinates and st.session_state.uploaded_image is not None:
-            client = get_vision_client()
-            if client:
-                roi_coords = st.session_state.coordinates["차량번호"]
-                roi_text = extract_text_from_region(client, None, "차량번호", roi_coords) or ""
-                m = re.search(r"(\d{4})(?!\d)", re.sub(r"\s+", "", roi_text))
-                if m:
-                    return m.group(1)
-    except Exception:
-        pass
-
-    vehicle_keywords = ["차량번호", "차량", "대상"]
-    lines = text.split("\n") if text else []
+_RE_LAST4 = re.compile(r"(\d{4})(?!\d)")
+_RE_BULLET = re.compile(r"^\s*[-•]\s*")
+_RE_HYPHEN_CODE = re.compile(r"\d{2,4}\s*-\s*\d{3,6}\s*-\s*\d{1,4}")  # 예: 2025-063822-00
+_RE_AMOUNT = re.compile(r"(?<!\d)(\d{1,3}(?:,\d{3})+|\d{4,})(?!\d)(\s*원)?")  # 금액 + '원' 여부
+_RE_PLATE = re.compile(r"(\d{2,3}[가-힣]\d{4})")
+_RE_PLATE_SPACED = re.compile(r"(\d{2,3}\s*[가-힣]\s*\d{4})")
+_RE_NUM_COMMA = re.compile(r"[\d,]+")
+_RE_NONDIGIT = re.compile(r"\D")
+_RE_TAIL_DIGITS = re.compile(r"(\d+)\D*$")  # 마지막 숫자 묶음
+
+_VEHICLE_KEYWORDS = ("차량번호", "차량", "대상")
+_PENALTY_KEYWORDS = ("원", "금액", "과태료", "범칙금")  # 차량번호 탐색에서 건너뛸 금액 줄
+_DATE_KEYWORDS = ("일시", "일자", "위반일", "발생일")
+_DUE_DATE_KEYWORDS = ("납부기한", "납기", "기한", "만료일")
+_LOCATION_KEYWORDS = (
+    "장소", "위치", "위반장소", "발생장소", "지점",
+    "cctv", "ic", "앞", "방향", "뒤", "주변", "근처", "단지",
+    "어린이보호구역", "로", "길", "대로", "교차로"
+)
+_PAYMENT_KEYWORDS = ("납부금액", "납기내금액")
+_FINE_KEYWORDS = ("과태료",)
+_FINE_EXCLUDE_KEYWORDS = ("감경", "가산")
+_VIOLATION_KEYWORDS = (
+    "주정차", "속도", "신호", "어린이보호", "중앙선", "끼어들기",
+    "횡단보도", "안전거리", "진로변경", "통행금지", "일시정지"
+)
+_CONTENT_KEYWORDS = ("내용", "위반", "사유", "항목")
+
+def _rows_by_priority(keywords, lines):
+    """키워드 우선순위 → 줄 순서대로, 키워드가 들어 있는 줄 번호를 필요한 만큼만 나열 (찾으면 호출 쪽에서 바로 중단)"""
+    for kw in keywords:
+        for i, line in enumerate(lines):
+            if kw in line:
+                yield i
+
+class ParsedText(NamedTuple):
+    """OCR 전체 텍스트의 공용 분석 결과 (추출기마다 다시 나누지 않도록 한 번만 생성)"""
+    full: str          # 원문
+    lines: list        # 줄 목록
+    lower_lines: list  # 소문자 줄 목록 (장소의 'cctv', 'ic'용, 줄 번호는 lines와 같음)
+
+def parse_text(full_text):
+    text = full_text or ""
+    return ParsedText(text, text.split("\n"), text.lower().split("\n"))
+
+def extract_all_fields(full_text):
+    """키워드 기반 필드 추출: 줄 분리는 한 번만 하고 결과를 모든 추출기가 공유"""
+    parsed = parse_text(full_text)
+    return {
+        "차량번호": extract_vehicle_number_from_text(parsed),
+        "일자": extract_date_from_text(parsed, _DATE_KEYWORDS),
+        "장소": extract_location_from_text(parsed),
+        "과태료": extract_fine_amount_from_text(parsed),
+        "납기일": extract_date_from_text(parsed, _DUE_DATE_KEYWORDS),
+        "내용": extract_violation_content_from_text(parsed),
+    }
+
+def extract_vehicle_number_from_text(parsed):
+    """차량번호: 키워드 주변 → 금액 줄 제외 → 전체 순으로 뒤 4자리만 사용 (텍스트만 사용, Vision 재호출 없음)"""
+    text, lines, _ = parsed
     for i, line in enumerate(lines):
-        if any(k in line for k in vehicle_keywords):
+        if any(k in line for k in _VEHICLE_KEYWORDS):
             search_text = line + (" " + lines[i + 1] if i + 1 < len(lines) else "")
-            m = re.search(r"(\d{4})(?!\d)", re.sub(r"\s+", "", search_text))
+            m = _RE_LAST4.search(_RE_WS.sub("", search_text))
             if m:
                 return m.group(1)
 
-    penalty_words = ("원", "금액", "과태료", "범칙금")
     for line in lines:
-        if any(p in line for p in penalty_words):
+        if any(p in line for p in _PENALTY_KEYWORDS):
             continue
-        m = re.search(r"(\d{4})(?!\d)", re.sub(r"\s+", "", line))
+        m = _RE_LAST4.search(_RE_WS.sub("", line))
         if m:
             return m.group(1)
 
-    m = re.search(r"(\d{4})(?!\d)", re.sub(r"\s+", "", text or ""))
+    m = _RE_LAST4.search(_RE_WS.sub("", text))
     return m.group(1) if m else ""
 
-def extract_date_from_text(text, keywords):
+def extract_date_from_text(parsed, keywords):
     """키워드 주변/전체에서 날짜를 찾아 fmt_date_uniform(YYYY/MM/DD)로 반환"""
+    text, lines, _ = parsed
     if not text:
         return fmt_date_uniform("")
-    lines = text.split('\n')
 
-    # 키워드 주변 탐색 (현재 줄 + 다음 줄)
-    for kw in keywords:
-        for i, line in enumerate(lines):
-            if kw in line:
-                seg = line + (" " + lines[i + 1] if i + 1 < len(lines) else "")
-                return fmt_date_uniform(seg)
+    # 키워드 주변 탐색 (우선순위가 가장 높은 키워드의 첫 줄 + 다음 줄)
+    for i in _rows_by_priority(keywords, lines):
+        seg = lines[i] + (" " + lines[i + 1] if i + 1 < len(lines) else "")
+        return fmt_date_uniform(seg)
 
     # 전체 텍스트에서 탐색
     return fmt_date_uniform(text)
 
-def extract_location_from_text(text):
-    location_keywords = [
-        "장소", "위치", "위반장소", "발생장소", "지점",
-        "cctv", "ic", "앞", "방향", "뒤", "주변", "근처", "단지",
-        "어린이보호구역", "로", "길", "대로", "교차로"
-    ]
-    lines = text.split('\n')
-    for keyword in location_keywords:
-        for line in lines:
-            if keyword in line.lower():
-                cleaned = re.sub(r'^\s*[-•]\s*', '', line.strip())
-                if len(cleaned) > 3:
-                    return cleaned
+def extract_location_from_text(parsed):
+    _, lines, lower_lines = parsed
+    for i in _rows_by_priority(_LOCATION_KEYWORDS, lower_lines):
+        cleaned = _RE_BULLET.sub('', lines[i].strip())
+        if len(cleaned) > 3:
+            return cleaned
     return ""
 
-def extract_fine_amount_from_text(text):
+def extract_fine_amount_from_text(parsed):
     """
     최종 납부 금액 추출 우선순위:
     1) '납부금액', '납기내금액' 줄에서 키워드 '뒤' 숫자
@@ -933,121 +1192,115 @@ def extract_fine_amount_from_text(text):
     3) 본문 어디서든 '숫자+원' 패턴
     4) 숫자 전체 검색 (문서번호 등 하이픈 코드 제거 후)
     """
+    text, lines, _ = parsed
     if not text:
         return ""
-    lines = text.split("\n")
 
-    def strip_hyphen_codes(s: str) -> str:
-        # 예: 2025-063822-00 같은 코드 제거
-        return re.sub(r"\d{2,4}\s*-\s*\d{3,6}\s*-\s*\d{1,4}", " ", s)
-
-    def find_amount_after_keyword(segment: str):
-        seg = strip_hyphen_codes(segment)
-        # '숫자+원'
-        m = re.search(r"(?<!\d)(\d{1,3}(?:,\d{3})+|\d{4,})\s*원", seg)
-        if m:
-            val = int(m.group(1).replace(",", ""))
-            if 10_000 <= val <= 500_000:
-                return val
-        # 숫자 나열
-        for n in re.findall(r"(?<!\d)(\d{1,3}(?:,\d{3})+|\d{4,})(?!\d)", seg):
-            val = int(n.replace(",", ""))
-            if 10_000 <= val <= 500_000:
-                return val
-        return None
+    def amount_after(key, i):
+        line = lines[i]
+        start = line.find(key) + len(key)
+        seg = line[start:] + (" " + lines[i + 1] if i + 1 < len(lines) else "")
+        return _pick_amount(seg)
 
     # 1) 납부금액/납기내금액
-    for key in ("납부금액", "납기내금액"):
-        for i, line in enumerate(lines):
-            if key in line:
-                start = line.find(key) + len(key)
-                seg = line[start:] + (" " + lines[i + 1] if i + 1 < len(lines) else "")
-                amt = find_amount_after_keyword(seg)
-                if amt is not None:
-                    return f"{amt:,}원"
+    for key in _PAYMENT_KEYWORDS:
+        for i in _rows_by_priority((key,), lines):
+            amt = amount_after(key, i)
+            if amt is not None:
+                return f"{amt:,}원"
 
     # 2) 과태료 (감경/가산 제외)
-    for i, line in enumerate(lines):
-        if "과태료" in line and "감경" not in line and "가산" not in line:
-            start = line.find("과태료") + len("과태료")
-            seg = line[start:] + (" " + lines[i + 1] if i + 1 < len(lines) else "")
-            amt = find_amount_after_keyword(seg)
+    for key in _FINE_KEYWORDS:
+        for i in _rows_by_priority((key,), lines):
+            if any(kw in lines[i] for kw in _FINE_EXCLUDE_KEYWORDS):
+                continue
+            amt = amount_after(key, i)
             if amt is not None:
                 return f"{amt:,}원"
 
-    # 3) 전체에서 '숫자+원'
-    cleaned = strip_hyphen_codes("\n".join(lines))
-    m = re.search(r"(?<!\d)(\d{1,3}(?:,\d{3})+|\d{4,})\s*원", cleaned)
-    if m:
-        val = int(m.group(1).replace(",", ""))
-        if 10_000 <= val <= 500_000:
-            return f"{val:,}원"
-
-    # 4) 숫자 전체 검색
-    for n in re.findall(r"(?<!\d)(\d{1,3}(?:,\d{3})+|\d{4,})(?!\d)", cleaned):
-        val = int(n.replace(",", ""))
-        if 10_000 <= val <= 500_000:
-            return f"{val:,}원"
-    return ""
+    # 3) 전체에서 '숫자+원', 4) 숫자 전체 검색
+    amt = _pick_amount(text)
+    return f"{amt:,}원" if amt is not None else ""
 
-def extract_violation_content_from_text(text):
-    violation_keywords = [
-        "주정차", "속도", "신호", "어린이보호", "중앙선", "끼어들기",
-        "횡단보도", "안전거리", "진로변경", "통행금지", "일시정지"
-    ]
-    lines = text.split('\n')
-    for keyword in violation_keywords:
-        for line in lines:
-            if keyword in line:
-                cleaned = line.strip()
-                if len(cleaned) > 2:
-                    return cleaned
-    content_keywords = ["내용", "위반", "사유", "항목"]
-    for keyword in content_keywords:
-        for i, line in enumerate(lines):
-            if keyword in line and i + 1 < len(lines):
-                nxt = lines[i + 1].strip()
-                if len(nxt) > 2:
-                    return nxt
+def _pick_amount(s):
+    """하이픈 코드(예: 2025-063822-00)를 지운 뒤 한 번의 스캔으로 금액 선택:
+    첫 '숫자+원'이 10,000~500,000원이면 그 값, 아니면 범위 안의 첫 숫자
+    """
+    first_in_range = None
+    won_checked = False
+    for m in _RE_AMOUNT.finditer(_RE_HYPHEN_CODE.sub(" ", s)):
+        val = int(m.group(1).replace(",", ""))
+        in_range = 10_000 <= val <= 500_000
+        if m.group(2) is not None and not won_checked:
+            if in_range:
+                return val
+            won_checked = True
+        if in_range and first_in_range is None:
+            first_in_range = val
+        if won_checked and first_in_range is not None:
+            return first_in_range
+    return first_in_range
+
+def extract_violation_content_from_text(parsed):
+    _, lines, _ = parsed
+    for i in _rows_by_priority(_VIOLATION_KEYWORDS, lines):
+        cleaned = lines[i].strip()
+        if len(cleaned) > 2:
+            return cleaned
+    for i in _rows_by_priority(_CONTENT_KEYWORDS, lines):
+        if i + 1 < len(lines):
+            nxt = lines[i + 1].strip()
+            if len(nxt) > 2:
+                return nxt
     return ""
 
-def extract_text_from_region(vision_client, image, field, coords):
-    """특정 영역에서 텍스트 추출 (image 파라미터는 사용하지 않음)"""
+def extract_text_from_words(words, field, coords):
+    """중심점이 영역 안에 있는 단어를 읽기 순서대로 이어 붙여 후처리"""
+    x1, y1, x2, y2 = coords
+    raw = " ".join(w for w, cx, cy in words if x1 <= cx <= x2 and y1 <= cy <= y2)
+    return post_process_text(field, raw)
+
+def extract_text_from_regions(vision_client, image, regions):
+    """여러 영역({영역: 원본 좌표})을 한 번의 batch 요청으로 재인식 (자른 뒤 축소·JPEG 인코딩은 스레드로 병렬 처리)"""
+    factor = image.size[0] / get_full_size(image)[0]
+    crops = [image.crop(tuple(scale_box(coords, factor))) for coords in regions.values()]
+    with ThreadPoolExecutor() as ex:
+        # 작은 글자 영역이라 화질을 조금 높임, libjpeg 인코딩은 GIL을 풀고 실행됨
+        contents = [content for content, _ in ex.map(lambda crop: _prep_for_vision(crop, quality=90), crops)]
     try:
-        x1, y1, x2, y2 = coords
-        pil_image = st.session_state.uploaded_image.crop((x1, y1, x2, y2))
-        buf = io.BytesIO()
-        pil_image.save(buf, format='PNG')
-        cropped = vision.Image(content=buf.getvalue())
-        response = vision_client.text_detection(image=cropped)
+        responses = _annotate_chunk(vision_client, contents)
+    except Exception as e:
+        st.warning(f"⚠️ 영역 OCR 실패: {e}")
+        return {field: "" for field in regions}
+
+    results = {}
+    for field, response in zip(regions, responses):
         if response.error.message:
-            raise Exception(f'{response.error.message}')
+            st.warning(f"⚠️ {field} 영역 OCR 실패: {response.error.message}")
+            results[field] = ""
+            continue
         texts = response.text_annotations
-        raw = texts[0].description.strip() if texts else ""
-        return post_process_text(field, raw)
-    except Exception as e:
-        st.warning(f"⚠️ {field} 영역 OCR 실패: {e}")
-        return ""
+        results[field] = post_process_text(field, texts[0].description.strip() if texts else "")
+    return results
 
 def post_process_text(field, raw_text):
     """필드별 후처리: 날짜는 fmt_date_uniform로 통일"""
     if not raw_text:
         return ""
-    text = re.sub(r'\s+', ' ', raw_text).strip()
+    text = _RE_WS.sub(' ', raw_text).strip()
 
     if field == "차량번호":
-        pats = [r'(\d{2,3}[가-힣]\d{4})', r'(\d{2,3}\s*[가-힣]\s*\d{4})']
-        for p in pats:
-            m = re.search(p, text)
+        for pat in (_RE_PLATE, _RE_PLATE_SPACED):
+            m = pat.search(text)
             if m:
-                return re.sub(r'\s+', '', m.group(1))
+                return _RE_WS.sub('', m.group(1))
         return text
 
     if field in ("일자", "납기일"):
         return fmt_date_uniform(text)
 
     if field == "과태료":
-        nums = re.findall(r'[\d,]+', text)
+        nums = _RE_NUM_COMMA.findall(text)
         for n in nums:
             try:
                 val = int(n.replace(',', ''))
@@ -1062,33 +1315,36 @@ def post_process_text(field, raw_text):
 # =========================
 # 매칭/결과 정리/표시
 # =========================
-def match_vehicle_number(ocr_vehicle_number):
+def build_last4_index(df):
+    """차량번호 뒤 4자리 → 행 위치 배열 (일괄 처리 시작 시 한 번만 만들어 모든 이미지가 공유)"""
+    if df is None or "_last4" not in df.columns:
+        return {}
+    return df.groupby("_last4", sort=False).indices
+
+def match_vehicle_number(ocr_vehicle_number, df, last4_index):
     """뒤 4자리 우선 매칭 + 유사도 보조"""
-    if not ocr_vehicle_number or st.session_state.vehicle_users_df is None:
+    if not ocr_vehicle_number or df is None:
         return None
-    ocr_digits = re.findall(r'\d+', ocr_vehicle_number)
+    ocr_digits = _RE_DIGITS.findall(ocr_vehicle_number)
     if not ocr_digits:
         return None
     last4 = ocr_digits[-1][-4:] if ocr_digits[-1] else ""
     if len(last4) != 4:
         return None
 
-    best = None
-    best_score = 0
-    for _, row in st.session_state.vehicle_users_df.iterrows():
-        vehicle_num = str(row.get('차량번호', ''))
-        vd = re.findall(r'\d+', vehicle_num)
-        if not vd:
-            continue
-        v_last4 = vd[-1][-4:] if vd[-1] else ""
-        if v_last4 == last4:
-            sim = SequenceMatcher(None, ocr_vehicle_number, vehicle_num).ratio()
-            if sim > best_score:
-                best_score = sim
-                best = row
-    return best
-
-def compile_final_results(matched_vehicle):
+    # 1차: 뒤 4자리 색인에서 후보 행 조회
+    rows = last4_index.get(last4)
+    if rows is None:
+        return None
+    if len(rows) == 1:
+        return df.iloc[rows[0]]
+
+    # 2차: 후보가 여럿일 때만 유사도 최고 (동점이면 앞쪽 행)
+    plates = df["차량번호"].iloc[rows].astype(str)
+    _, _, best_idx = process.extractOne(ocr_vehicle_number, plates, scorer=fuzz.ratio)
+    return df.loc[best_idx]
+
+def compile_final_results(matched_vehicle, ocr_results):
     """최종 결과 정리 (사용자=성명, 감경금액 포함, 날짜는 YYYY/MM/DD)"""
     result = {}
     if matched_vehicle is not None:
@@ -1099,19 +1355,19 @@ def compile_final_results(matched_vehicle):
     else:
         result['부서'] = '매칭 실패'
         result['사용자'] = '매칭 실패'
-        result['차량번호'] = st.session_state.ocr_results.get('차량번호', '')
+        result['차량번호'] = ocr_results.get('차량번호', '')
 
-    # OCR 결과
-    result['일자']   = fmt_date_uniform(st.session_state.ocr_results.get('일자', ''))
-    result['장소']   = st.session_state.ocr_results.get('장소', '')
-    result['내용']   = st.session_state.ocr_results.get('내용', '')
-    result['과태료'] = st.session_state.ocr_results.get('과태료', '')
-    result['납기일'] = fmt_date_uniform(st.session_state.ocr_results.get('납기일', ''))
+    # OCR 결과 (날짜는 추출 단계에서 이미 YYYY/MM/DD로 통일됨, 빈 값만 기본 형식으로)
+    result['일자']   = ocr_results.get('일자') or fmt_date_uniform('')
+    result['장소']   = ocr_results.get('장소', '')
+    result['내용']   = ocr_results.get('내용', '')
+    result['과태료'] = ocr_results.get('과태료', '')
+    result['납기일'] = ocr_results.get('납기일') or fmt_date_uniform('')
 
     # 감경금액(20%)
     try:
         fine_text = result['과태료']
-        fine_amount = int(re.sub(r'[^\d]', '', fine_text)) if fine_text else 0
+        fine_amount = int(_RE_NONDIGIT.sub('', fine_text)) if fine_text else 0
         discounted = int(fine_amount * 0.8)
         result['감경금액'] = f"{discounted:,}원"
     except:
@@ -1164,12 +1420,10 @@ def show_final_results():
     st.code(result.get("내용", ""))
 
 def show_detailed_ocr_results():
-    """상세 OCR 결과 (날짜는 YYYY/MM/DD로 통일 표시)"""
+    """상세 OCR 결과 (날짜는 추출 단계에서 이미 YYYY/MM/DD로 통일됨)"""
     method = "템플릿 기반" if st.session_state.get('is_police_notice', False) else "키워드 기반"
     st.markdown(f"#### 🔍 {method} OCR 결과")
     for field, text in st.session_state.ocr_results.items():
-        if field in ("일자", "납기일") and text:
-            text = fmt_date_uniform(text)
         color = FIELD_COLORS.get(field, "#000000")
         if text and str(text).strip():
             st.markdown(f'<span style="color:{color}">●</span> **{field}**: {text}', unsafe_allow_html=True)
@@ -1212,6 +1466,9 @@ def show_vehicle_matching_info():
 # =========================
 # 결과 확인/다운로드
 # =========================
+def batch_results_frame(batch):
+    return pd.DataFrame(batch).sort_values(by=["_index"]).drop(columns=["_index"], errors="ignore")
+
 def results_section():
     st.markdown("### 📦 일괄 결과 요약")
     batch = st.session_state.batch_results or []
@@ -1221,10 +1478,11 @@ def results_section():
             reset_all_states()
             st.rerun()
         return
-    df = pd.DataFrame(batch).sort_values(by=["_index"]).drop(columns=["_index"], errors="ignore")
-    st.dataframe(df, use_container_width=True)
+    st.dataframe(batch_results_frame(batch), use_container_width=True)
 
-    csv = df.to_csv(index=False).encode("utf-8-sig")
+    csv = st.session_state.batch_csv
+    if csv is None:  # 결과만 있고 CSV가 없으면 한 번 만들어 보관
+        csv = st.session_state.batch_csv = batch_results_frame(batch).to_csv(index=False).encode("utf-8-sig")
     st.download_button(
         label="⬇️ CSV 다운로드",
         data=csv,